@@ -0,0 +1,398 @@
+# -*- coding: utf-8 -*-
+
+"""Asynchronous GCS transfers using ``gcloud-aio-storage``.
+
+The coroutines in this module mirror :py:func:`rhg_compute_tools.gcs.rm`,
+:py:func:`rhg_compute_tools.gcs.cp` and :py:func:`rhg_compute_tools.gcs.sync`,
+issuing up to ``max_concurrency`` requests at once from a single thread. This
+scales better than a thread pool when transferring many small files. The
+functions :py:func:`rm`, :py:func:`cp` and :py:func:`sync` run the coroutines
+with :py:func:`asyncio.run` for use from synchronous code.
+
+Requires the optional ``gcloud-aio-storage`` package.
+"""
+
+import asyncio
+import os
+import random
+from datetime import datetime as dt
+from os.path import basename, isdir, join
+
+from rhg_compute_tools.gcs import (
+    LIST_PAGE_SIZE,
+    _check_flags,
+    _check_sync_source,
+    _diff_manifests,
+    _get_path_types,
+    _is_transient_status,
+    _join_blob,
+    _local_manifest,
+    _parse_gs_url,
+    _to_gs,
+)
+
+try:
+    from aiohttp import ClientConnectionError, ClientResponseError
+    from gcloud.aio.storage import Storage
+except ModuleNotFoundError:
+    Storage = None
+
+
+def _get_storage(credentials=None):
+    if Storage is None:
+        raise ImportError(
+            "rhg_compute_tools.aio requires gcloud-aio-storage. Install it with "
+            "`pip install gcloud-aio-storage`"
+        )
+
+    if credentials is not None:
+        credentials = str(credentials)
+
+    return Storage(service_file=credentials)
+
+
+async def _retry(func, *args, max_tries=5, **kwargs):
+    """Await ``func(*args, **kwargs)``, retrying 429 and 5xx responses and connection
+    errors with exponential backoff"""
+    for attempt in range(max_tries):
+        if attempt > 0:
+            await asyncio.sleep(min(2 ** attempt, 32) + random.random())
+
+        try:
+            return await func(*args, **kwargs)
+        except ClientResponseError as e:
+            if not _is_transient_status(e.status) or attempt == max_tries - 1:
+                raise
+        except ClientConnectionError:
+            if attempt == max_tries - 1:
+                raise
+
+
+async def _list_pages(storage, bucket_name, prefix=None, fields="items(name)"):
+    """Asynchronously iterate over pages of the objects below ``prefix``"""
+    params = {"fields": fields + ",nextPageToken", "maxResults": str(LIST_PAGE_SIZE)}
+    if prefix:
+        params["prefix"] = prefix
+
+    while True:
+        response = await _retry(storage.list_objects, bucket_name, params=params)
+
+        yield response.get("items", [])
+
+        if not response.get("nextPageToken"):
+            return
+
+        params = dict(params, pageToken=response["nextPageToken"])
+
+
+async def _list_objects(storage, bucket_name, prefix=None, fields="items(name)"):
+    """Asynchronously iterate over the objects below ``prefix``"""
+    async for page in _list_pages(storage, bucket_name, prefix, fields):
+        for item in page:
+            yield item
+
+
+async def _isdir(storage, bucket_name, blob_name):
+    if not blob_name.strip("/"):
+        return True
+
+    response = await storage.list_objects(
+        bucket_name,
+        params={
+            "prefix": blob_name.rstrip("/") + "/",
+            "maxResults": "1",
+            "fields": "items(name)",
+        },
+    )
+
+    return len(response.get("items", [])) > 0
+
+
+async def _manifest(storage, bucket_name, prefix, recursive=True):
+    """Map names of blobs below ``prefix`` to ``(size, crc32c)``"""
+    prefix = prefix.rstrip("/") + "/" if prefix.strip("/") else ""
+    manifest = {}
+
+    items = _list_objects(
+        storage, bucket_name, prefix=prefix, fields="items(name,size,crc32c)"
+    )
+
+    async for item in items:
+        rel = item["name"][len(prefix) :]
+        if not rel or rel.endswith("/"):
+            continue
+        if not recursive and "/" in rel:
+            continue
+        manifest[rel] = (int(item["size"]), item["crc32c"])
+
+    return manifest
+
+
+async def _delete(sem, storage, bucket_name, name):
+    async with sem:
+        try:
+            await _retry(storage.delete, bucket_name, name)
+        except ClientResponseError as e:
+            # treat blobs which are already gone as deleted
+            if e.status != 404:
+                raise
+
+    return f"Removed gs://{bucket_name}/{name}"
+
+
+async def _upload(sem, storage, bucket_name, local, remote):
+    async with sem:
+        await _retry(storage.upload_from_filename, bucket_name, remote, local)
+
+    return f"Copied {local} to gs://{bucket_name}/{remote}"
+
+
+async def _download(sem, storage, bucket_name, remote, local):
+    local_dir = os.path.dirname(local)
+    if local_dir:
+        os.makedirs(local_dir, exist_ok=True)
+
+    async with sem:
+        await _retry(storage.download_to_filename, bucket_name, remote, local)
+
+    return f"Copied gs://{bucket_name}/{remote} to {local}"
+
+
+async def _cp_transfers(storage, src, dest, recursive=False):
+    """Plan the file transfers made by ``gsutil cp``"""
+    if not src.startswith("gs://") and dest.startswith("gs://"):
+        bucket_name, dest_name = _parse_gs_url(dest)
+        dest_isdir = await _isdir(storage, bucket_name, dest_name)
+
+        if isdir(src):
+            if not recursive:
+                raise ValueError(f"{src} is a directory. Use flags=['r'] to copy it")
+            if dest_isdir:
+                dest_name = _join_blob(dest_name, basename(src.rstrip("/")))
+            return [
+                (_upload, bucket_name, join(src, rel), _join_blob(dest_name, rel))
+                for rel in _local_manifest(src)
+            ]
+
+        if dest_isdir or dest_name.endswith("/"):
+            dest_name = _join_blob(dest_name, basename(src))
+        return [(_upload, bucket_name, src, dest_name)]
+
+    if src.startswith("gs://") and not dest.startswith("gs://"):
+        bucket_name, src_name = _parse_gs_url(src)
+
+        if recursive:
+            manifest = await _manifest(storage, bucket_name, src_name)
+            if manifest:
+                if isdir(dest):
+                    dest = join(dest, basename(src_name.rstrip("/")))
+                return [
+                    (_download, bucket_name, _join_blob(src_name, rel), join(dest, rel))
+                    for rel in manifest
+                ]
+
+        if isdir(dest):
+            dest = join(dest, basename(src_name))
+        return [(_download, bucket_name, src_name, dest)]
+
+    raise ValueError("rhg_compute_tools.aio can only copy between local paths and GCS")
+
+
+async def async_rm(path, flags=[], credentials=None, max_concurrency=64):
+    """Remove a file or recursively remove a directory on GCS
+
+    Objects are deleted a page of the listing at a time, so memory use doesn't
+    grow with the number of objects. Requests failing with a transient error
+    (429 or 5xx) are retried with exponential backoff.
+
+    Parameters
+    ----------
+    path : str or :class:`pathlib.Path`
+        The path to the file or directory. Either the `/gcs` or `gs:/` prefix
+        will work.
+    flags : list of str, optional
+        Flags as accepted by :py:func:`rhg_compute_tools.gcs.rm`. Only `r`
+        (recursive remove) is supported.
+    credentials : str or None, optional
+        Path to a service account credentials file. If None (default), the
+        credentials of the current environment are used.
+    max_concurrency : int, optional
+        Maximum number of requests in flight at once (default 64)
+
+    Returns
+    -------
+    str
+        Removed blobs
+    str
+        Empty string, for consistency with :py:func:`rhg_compute_tools.gcs.rm`
+    :py:class:`datetime.timedelta`
+        Time it took to remove file(s).
+    """
+    st_time = dt.now()
+
+    path = _to_gs(str(path))
+    bucket_name, blob_name = _parse_gs_url(path)
+    sem = asyncio.Semaphore(max_concurrency)
+
+    _check_flags(flags, ["r"])
+
+    async with _get_storage(credentials) as storage:
+        if "r" in flags:
+            prefix = blob_name.rstrip("/") + "/" if blob_name else None
+            lines = []
+            async for page in _list_pages(storage, bucket_name, prefix=prefix):
+                lines += await asyncio.gather(
+                    *(_delete(sem, storage, bucket_name, item["name"]) for item in page)
+                )
+        else:
+            lines = [await _delete(sem, storage, bucket_name, blob_name)]
+
+    return "\n".join(lines), "", dt.now() - st_time
+
+
+async def async_cp(src, dest, flags=[], credentials=None, max_concurrency=64):
+    """Copy a file or recursively copy a directory from a local path to GCS
+    or vice versa
+
+    Parameters
+    ----------
+    src, dest : str
+        The paths to the source and destination file or directory.
+        If on GCS, either the `/gcs` or `gs:/` prefix will work.
+    flags : list of str, optional
+        Flags as accepted by :py:func:`rhg_compute_tools.gcs.cp`. Only `r`
+        (recursive copy) is supported.
+    credentials : str or None, optional
+        Path to a service account credentials file. If None (default), the
+        credentials of the current environment are used.
+    max_concurrency : int, optional
+        Maximum number of requests in flight at once (default 64)
+
+    Returns
+    -------
+    str
+        Copied files
+    str
+        Empty string, for consistency with :py:func:`rhg_compute_tools.gcs.cp`
+    :py:class:`datetime.timedelta`
+        Time it took to copy file(s).
+    """
+    st_time = dt.now()
+
+    _check_flags(flags, ["r"])
+
+    src_gs, _, dest_gs, _ = _get_path_types(str(src), str(dest))
+    sem = asyncio.Semaphore(max_concurrency)
+
+    async with _get_storage(credentials) as storage:
+        transfers = await _cp_transfers(
+            storage, src_gs, dest_gs, recursive=("r" in flags)
+        )
+        lines = await asyncio.gather(
+            *(func(sem, storage, *args) for func, *args in transfers)
+        )
+
+    return "\n".join(lines), "", dt.now() - st_time
+
+
+async def async_sync(
+    src, dest, flags=["r", "d"], credentials=None, max_concurrency=64
+):
+    """Sync a directory from local to GCS or vice versa
+
+    Files are copied if they are missing from `dest` or differ in size or
+    CRC32C checksum. Raises ``ValueError`` if a local `src` is not a
+    directory, or if `src` is empty and the `d` flag is set.
+
+    Parameters
+    ----------
+    src, dest : str
+        The paths to the source and destination directories.
+        If on GCS, either the `/gcs` or `gs:/` prefix will work.
+    flags : list of str, optional
+        Flags as accepted by :py:func:`rhg_compute_tools.gcs.sync`. Only `r`
+        (recursive) and `d` (delete files on dest that are not on src) are
+        supported. Default ``['r', 'd']``.
+    credentials : str or None, optional
+        Path to a service account credentials file. If None (default), the
+        credentials of the current environment are used.
+    max_concurrency : int, optional
+        Maximum number of requests in flight at once (default 64)
+
+    Returns
+    -------
+    str
+        Copied and removed files
+    str
+        Empty string, for consistency with :py:func:`rhg_compute_tools.gcs.sync`
+    :py:class:`datetime.timedelta`
+        Time it took to sync file(s).
+    """
+    st_time = dt.now()
+
+    src_gs, _, dest_gs, _ = _get_path_types(
+        str(src).rstrip("/"), str(dest).rstrip("/")
+    )
+    _check_flags(flags, ["r", "d"])
+
+    recursive = "r" in flags
+    sem = asyncio.Semaphore(max_concurrency)
+
+    async with _get_storage(credentials) as storage:
+        if not src_gs.startswith("gs://") and dest_gs.startswith("gs://"):
+            bucket_name, prefix = _parse_gs_url(dest_gs)
+            src_manifest = _local_manifest(src_gs, recursive=recursive)
+            _check_sync_source(src_gs, src_manifest, "d" in flags)
+            dest_manifest = await _manifest(storage, bucket_name, prefix, recursive)
+            changed, extra = _diff_manifests(src_manifest, dest_manifest, src_gs)
+
+            tasks = [
+                _upload(sem, storage, bucket_name, join(src_gs, rel), remote)
+                for rel, remote in ((r, _join_blob(prefix, r)) for r in changed)
+            ]
+            if "d" in flags:
+                tasks += [
+                    _delete(sem, storage, bucket_name, _join_blob(prefix, rel))
+                    for rel in extra
+                ]
+            lines = list(await asyncio.gather(*tasks))
+
+        elif src_gs.startswith("gs://") and not dest_gs.startswith("gs://"):
+            bucket_name, prefix = _parse_gs_url(src_gs)
+            src_manifest = await _manifest(storage, bucket_name, prefix, recursive)
+            _check_sync_source(src_gs, src_manifest, "d" in flags)
+            dest_manifest = _local_manifest(dest_gs, recursive=recursive)
+            changed, extra = _diff_manifests(src_manifest, dest_manifest, dest_gs)
+
+            tasks = [
+                _download(sem, storage, bucket_name, remote, join(dest_gs, rel))
+                for rel, remote in ((r, _join_blob(prefix, r)) for r in changed)
+            ]
+            lines = list(await asyncio.gather(*tasks))
+
+            if "d" in flags:
+                for rel in extra:
+                    os.remove(join(dest_gs, rel))
+                lines += [f"Removed {join(dest_gs, rel)}" for rel in extra]
+
+        else:
+            raise ValueError(
+                "rhg_compute_tools.aio can only sync between local paths and GCS"
+            )
+
+    return "\n".join(lines), "", dt.now() - st_time
+
+
+def rm(path, flags=[], credentials=None, max_concurrency=64):
+    """Run :py:func:`async_rm` to completion. See that function for details."""
+    return asyncio.run(async_rm(path, flags, credentials, max_concurrency))
+
+
+def cp(src, dest, flags=[], credentials=None, max_concurrency=64):
+    """Run :py:func:`async_cp` to completion. See that function for details."""
+    return asyncio.run(async_cp(src, dest, flags, credentials, max_concurrency))
+
+
+def sync(src, dest, flags=["r", "d"], credentials=None, max_concurrency=64):
+    """Run :py:func:`async_sync` to completion. See that function for details."""
+    return asyncio.run(async_sync(src, dest, flags, credentials, max_concurrency))
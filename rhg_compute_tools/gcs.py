@@ -2,23 +2,116 @@
 
 """Tools for interacting with GCS infrastructure."""
 
+import base64
+import collections
+import concurrent.futures
+import functools
+import itertools
+import json
+import logging
 import os
+import random
 import re
 import shlex
 import subprocess
+import threading
+import time
+import warnings
 
 from pathlib import Path
 from tqdm.auto import tqdm
 from datetime import datetime as dt
 from os.path import basename, exists, isdir, join
 
+import google_crc32c
+from google.api_core import exceptions
+from google.api_core.retry import Retry, if_transient_error
 from google.cloud import storage
+from google.cloud.storage import transfer_manager
 from google.oauth2 import service_account
 
+logger = logging.getLogger(__name__)
 
+if google_crc32c.implementation != "c":
+    warnings.warn(
+        "google-crc32c is using its pure python implementation, so checksums of "
+        "files transferred with the storage API will be slow. Reinstall "
+        "google-crc32c from a wheel built for your platform."
+    )
+
+# the storage API transfers in cp and sync copy files in batches of BATCH_SIZE
+# files each, with up to MAX_CONCURRENT_BATCHES batches in flight at once
+BATCH_SIZE = int(os.environ.get("RHG_GCS_BATCH_SIZE", 16))
+MAX_CONCURRENT_BATCHES = int(os.environ.get("RHG_GCS_MAX_CONCURRENT_BATCHES", 4))
+
+# retry policy for requests made by the storage API transfers. Retries 429 and
+# 5xx responses and connection errors with exponential backoff for up to 5 min.
+DEFAULT_RETRY = Retry(
+    initial=1.0,
+    maximum=30.0,
+    multiplier=2.0,
+    deadline=300.0,
+    predicate=if_transient_error,
+)
+
+# maximum number of subrequests sent in a single JSON API batch request
+BATCH_DELETE_SIZE = 100
+
+# maximum number of results returned per page by the JSON API list method
+LIST_PAGE_SIZE = 1000
+
+# partial responses requested when listing blobs. nextPageToken has to be
+# requested explicitly, otherwise listings stop after the first page.
+_RM_LIST_FIELDS = "items(name,generation),nextPageToken"
+_SYNC_LIST_FIELDS = "items(name,size,crc32c),nextPageToken"
+_DIRS_LIST_FIELDS = "items(name),nextPageToken"
+
+# files larger than MULTIPART_THRESHOLD bytes are uploaded by the storage API in
+# chunks of MULTIPART_CHUNKSIZE bytes, MULTIPART_MAX_CONCURRENCY at a time. Each
+# chunk in flight is held in memory, so each cp or sync uploads at most
+# MULTIPART_MAX_FILES files in chunks at once, however many files it transfers
+# concurrently.
+MULTIPART_THRESHOLD = int(
+    os.environ.get("RHG_GCS_MULTIPART_THRESHOLD", 150 * 1024 * 1024)
+)
+MULTIPART_CHUNKSIZE = int(
+    os.environ.get("RHG_GCS_MULTIPART_CHUNKSIZE", 150 * 1024 * 1024)
+)
+MULTIPART_MAX_CONCURRENCY = int(
+    os.environ.get("RHG_GCS_MULTIPART_MAX_CONCURRENCY", 10)
+)
+MULTIPART_MAX_FILES = int(os.environ.get("RHG_GCS_MULTIPART_MAX_FILES", 1))
+
+
+def _lru_cache_hashable(func):
+    """Cache ``func`` like ``functools.lru_cache``, but call it uncached when
+    its arguments aren't hashable rather than raising ``TypeError``"""
+    cached = functools.lru_cache(maxsize=8)(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            hash((args, tuple(kwargs.items())))
+        except TypeError:
+            return func(*args, **kwargs)
+        return cached(*args, **kwargs)
+
+    wrapper.cache_clear = cached.cache_clear
+    wrapper.cache_info = cached.cache_info
+
+    return wrapper
+
+
+@_lru_cache_hashable
 def authenticated_client(credentials=None, **client_kwargs):
     """Convenience function to create an authenticated GCS client.
 
+    Clients are cached on the arguments, so repeated calls share a single
+    client rather than re-reading the credentials file. Calls with unhashable
+    arguments, e.g. ``client_options={...}``, always create a new client. Call
+    ``authenticated_client.cache_clear()`` to force new clients to be created,
+    e.g. after the credentials file has changed.
+
     Parameters
     ----------
     credentials : str or None, optional
@@ -29,7 +122,7 @@ def authenticated_client(credentials=None, **client_kwargs):
         https://googleapis.dev/python/google-api-core/latest/auth.html)
         for an overview of the authorization options.
     client_kwargs : optional
-        kwargs to pass to the `get_client` function
+        kwargs to pass to the `get_client` function.
 
     Returns
     -------
@@ -49,6 +142,9 @@ def get_bucket(
 ):
     """Return a bucket object from Rhg's GCS system.
 
+    The client is shared through :py:func:`authenticated_client`, but a new
+    bucket object is looked up on each call.
+
     Parameters
     ----------
     credentials : str or None, optional
@@ -63,7 +159,7 @@ def get_bucket(
     return_client : bool, optional
         Return the Client object as a second object.
     client_kwargs : optional
-        kwargs to pass to the `get_client` function
+        kwargs to pass to the `get_client` function.
 
     Returns
     -------
@@ -79,27 +175,185 @@ def get_bucket(
 
 
 def _remove_prefix(text, prefix="/gcs/rhg-data/"):
-    return text[text.startswith(prefix) and len(prefix) :]
+    # equivalent to str.removeprefix, which requires python 3.9
+    if prefix and text.startswith(prefix):
+        return text[len(prefix) :]
+    return text
+
+
+def _to_gs(path):
+    """Convert a `/gcs/` path to a `gs://` url. Other paths are unchanged."""
+    return "gs://" + path[5:] if path.startswith("/gcs/") else path
+
+
+def _to_gcs(path):
+    """Convert a `gs://` url to a `/gcs/` path. Other paths are unchanged."""
+    return "/gcs/" + path[5:] if path.startswith("gs://") else path
 
 
 def _get_path_types(src, dest):
-    src_gs = src
-    src_gcs = src
-    dest_gs = dest
-    dest_gcs = dest
-    if src_gs.startswith("/gcs/"):
-        src_gs = src.replace("/gcs/", "gs://")
-    if src_gcs.startswith("gs://"):
-        src_gs = src.replace("gs://", "/gcs/")
-    if dest_gs.startswith("/gcs/"):
-        dest_gs = dest.replace("/gcs/", "gs://")
-    if dest_gcs.startswith("gs://"):
-        dest_gcs = dest.replace("gs://", "/gcs/")
-
-    return src_gs, src_gcs, dest_gs, dest_gcs
-
-
-def rm(path, flags=[]):
+    return _to_gs(src), _to_gcs(src), _to_gs(dest), _to_gcs(dest)
+
+
+def _format_cmd(cmd):
+    """Format an argument list as a shell command for display"""
+    return " ".join(shlex.quote(arg) for arg in cmd)
+
+
+def _flag_args(flags):
+    """Convert flags to gsutil arguments, e.g. ``['r', 'z html']`` to
+    ``['-r', '-z', 'html']``. Flags taking a value are split shell-style."""
+    return [arg for f in flags for arg in shlex.split("-" + f)]
+
+
+def _parse_gs_url(url):
+    """Split a ``gs://bucket/path/to/blob`` url into bucket and blob names"""
+    if not url.startswith("gs://"):
+        raise ValueError("url must begin with `gs://` or `/gcs/`")
+
+    bucket_name, _, blob_name = url[5:].partition("/")
+
+    return bucket_name, blob_name
+
+
+def _chunked(iterable, size):
+    """Lazily yield lists of up to ``size`` items from ``iterable``"""
+    iterator = iter(iterable)
+    chunk = list(itertools.islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(iterator, size))
+
+
+def _is_transient_status(status_code):
+    return status_code == 429 or status_code >= 500
+
+
+def _delete_blob_batch(client, blobs, max_tries=5):
+    """Delete up to ``BATCH_DELETE_SIZE`` blobs in one JSON API batch request
+
+    Each delete is conditional on the generation of the blob, if known, so a
+    blob which was overwritten after it was listed is left in place and
+    skipped. The batch request is retried according to ``DEFAULT_RETRY`` if
+    it fails with a transient error (429, 5xx or a connection error), and
+    subrequests which fail with a transient error are re-sent with
+    exponential backoff. Blobs which no longer exist are treated as deleted.
+
+    Parameters
+    ----------
+    client : google.cloud.storage.client.Client
+    blobs : list of google.cloud.storage.blob.Blob
+    max_tries : int, optional
+        Number of times to send each subrequest before giving up (default 5)
+
+    Returns
+    -------
+    list of str
+        Names of the deleted blobs
+    """
+    deleted = []
+    pending = list(blobs)
+
+    for attempt in range(max_tries):
+        if attempt > 0:
+            time.sleep(min(2 ** attempt, 32) + random.random())
+
+        # deletes are deferred on the batch while it is the client's current
+        # batch, then sent explicitly so the subresponses are returned. Leaving
+        # a ``with batch:`` block would send it and discard the subresponses.
+        # Note that Client._push_batch and Client._pop_batch are private
+        # google-cloud-storage APIs (used by Batch.__enter__ and __exit__),
+        # which keep a stack of batches per thread as of version 3.17.
+        batch = client.batch(raise_exception=False)
+        client._push_batch(batch)
+        try:
+            for blob in pending:
+                blob.delete(if_generation_match=blob.generation)
+        finally:
+            client._pop_batch()
+
+        # failures of the batch request as a whole are retried by DEFAULT_RETRY
+        responses = DEFAULT_RETRY(batch.finish)(raise_exception=False)
+
+        failed = []
+        for blob, response in zip(pending, responses):
+            if response.status_code < 300 or response.status_code == 404:
+                deleted.append(blob.name)
+            elif response.status_code == 412:
+                logger.warning(
+                    "Skipping %s: it was modified after it was listed", blob.name
+                )
+            elif _is_transient_status(response.status_code):
+                failed.append((blob, response))
+            else:
+                raise exceptions.from_http_response(response)
+
+        if not failed:
+            return deleted
+
+        pending = [blob for blob, _ in failed]
+        logger.warning(
+            "Retrying %d deletes after transient errors (attempt %d of %d)",
+            len(pending),
+            attempt + 1,
+            max_tries,
+        )
+
+    raise exceptions.from_http_response(failed[-1][1])
+
+
+def _next_page(pages):
+    page = next(pages, None)
+    return None if page is None else list(page)
+
+
+def _iter_pages(iterator):
+    """Yield the pages of a listing as lists of items
+
+    The next page is requested in a background thread while the caller
+    processes the current one.
+    """
+    pages = iter(iterator.pages)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as prefetcher:
+        next_page = prefetcher.submit(_next_page, pages)
+        while True:
+            page = next_page.result()
+            if page is None:
+                return
+
+            next_page = prefetcher.submit(_next_page, pages)
+            yield page
+
+
+def _list_blobs_to_remove(client, path, recursive=False):
+    """Yield pages of the blobs removed by ``gsutil rm``"""
+    bucket_name, blob_name = _parse_gs_url(path)
+
+    if recursive:
+        prefix = blob_name.rstrip("/") + "/" if blob_name else None
+        blobs = client.list_blobs(
+            bucket_name,
+            prefix=prefix,
+            page_size=LIST_PAGE_SIZE,
+            fields=_RM_LIST_FIELDS,
+        )
+        yield from _iter_pages(blobs)
+        return
+
+    blobs = client.list_blobs(
+        bucket_name,
+        prefix=blob_name,
+        delimiter="/",
+        page_size=LIST_PAGE_SIZE,
+        fields=_RM_LIST_FIELDS,
+    )
+
+    for page in _iter_pages(blobs):
+        yield [b for b in page if b.name == blob_name]
+
+
+def rm(path, flags=[], use_batch=False, client=None, threads=16):
     """Remove a file or recursively remove a directory from local
     path to GCS or vice versa. Must have already authenticated to use.
     Notebook servers are automatically authenticated, but workers
@@ -117,11 +371,23 @@ def rm(path, flags=[]):
         String of flags to add to the gsutil rm command. e.g.
         `flags=['r']` will run the command `gsutil -m rm -r...`
         (recursive remove)
+    use_batch : bool, optional
+        Delete blobs with the google cloud storage JSON API rather than
+        `gsutil`, sending up to 100 deletions per HTTP request. Only the
+        `r` flag is supported in this mode, and other flags raise a
+        ``ValueError``. Default False.
+    client : google.cloud.storage.client.Client or None, optional
+        Authenticated client used when ``use_batch=True``. If None (default)
+        a client is created with :py:func:`authenticated_client`.
+    threads : int, optional
+        Number of batch requests to send concurrently when ``use_batch=True``
+        (default 16). The client is shared across threads.
 
     Returns
     -------
     str
-        stdout from gsutil call
+        stdout from gsutil call, or the list of removed blobs if
+        ``use_batch=True``
     str
         stderr from gsutil call
     :py:class:`datetime.timedelta`
@@ -130,12 +396,43 @@ def rm(path, flags=[]):
 
     st_time = dt.now()
 
-    path = str(path).replace("/gcs/", "gs://")
+    path = _to_gs(str(path))
+
+    if use_batch:
+        _check_flags(flags, ["r"])
+
+        if client is None:
+            client = authenticated_client()
+
+        bucket_name, _ = _parse_gs_url(path)
+        pages = _list_blobs_to_remove(client, path, recursive=("r" in flags))
+
+        # batches are submitted as the listing pages arrive, so deletion of the
+        # first blobs overlaps with listing the rest. The number of batches
+        # waiting to be sent is bounded so memory use doesn't grow with the
+        # number of blobs listed.
+        deleted = []
+        pending = set()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            for page in pages:
+                for chunk in _chunked(page, BATCH_DELETE_SIZE):
+                    if len(pending) >= 2 * threads:
+                        done, pending = concurrent.futures.wait(
+                            pending, return_when=concurrent.futures.FIRST_COMPLETED
+                        )
+                        deleted += [name for f in done for name in f.result()]
+
+                    pending.add(executor.submit(_delete_blob_batch, client, chunk))
+
+            deleted += [name for f in pending for name in f.result()]
 
-    cmd = "gsutil -m rm " + " ".join(["-" + f for f in flags]) + f" {path}"
+        stdout = "\n".join(f"Removed gs://{bucket_name}/{name}" for name in deleted)
 
-    print(f"Running cmd: {cmd}")
-    cmd = shlex.split(cmd)
+        return stdout, "", dt.now() - st_time
+
+    cmd = ["gsutil", "-m", "rm", *_flag_args(flags), path]
+
+    print(f"Running cmd: {_format_cmd(cmd)}")
     p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     stdout, stderr = p.communicate()
 
@@ -186,7 +483,450 @@ def replicate_directory_structure_on_gcs(src, dst, client):
         blob.upload_from_string("")
 
 
-def cp(src, dest, flags=[]):
+def _join_blob(prefix, name):
+    return prefix.rstrip("/") + "/" + name if prefix else name
+
+
+def _gcs_isdir(client, bucket_name, blob_name):
+    """Check whether any blobs exist below ``blob_name`` in a bucket"""
+    if not blob_name.strip("/"):
+        return True
+
+    blobs = client.list_blobs(
+        bucket_name,
+        prefix=blob_name.rstrip("/") + "/",
+        max_results=1,
+        fields="items(name)",
+    )
+
+    return any(True for _ in blobs)
+
+
+def _local_manifest(root, recursive=True):
+    """Map paths of files below ``root`` to ``(size, None)``
+
+    Checksums of local files are only computed when needed, by
+    :py:func:`_diff_manifests`.
+    """
+    manifest = {}
+
+    for d, dirnames, files in os.walk(root):
+        for f in files:
+            path = join(d, f)
+            rel = os.path.relpath(path, root).replace(os.sep, "/")
+            manifest[rel] = (os.path.getsize(path), None)
+
+        if not recursive:
+            break
+
+    return manifest
+
+
+def _gcs_manifest(client, bucket_name, prefix, recursive=True):
+    """Map names of blobs below ``prefix`` to ``(size, crc32c)``
+
+    Names are relative to ``prefix``. Directory placeholder blobs are skipped.
+    """
+    prefix = prefix.rstrip("/") + "/" if prefix.strip("/") else ""
+    manifest = {}
+
+    blobs = client.list_blobs(
+        bucket_name,
+        prefix=(prefix or None),
+        fields=_SYNC_LIST_FIELDS,
+    )
+
+    for blob in blobs:
+        rel = blob.name[len(prefix) :]
+        if not rel or rel.endswith("/"):
+            continue
+        if not recursive and "/" in rel:
+            continue
+        manifest[rel] = (blob.size, blob.crc32c)
+
+    return manifest
+
+
+def _file_crc32c(path):
+    """Return the base64-encoded CRC32C checksum of a file, as reported by GCS"""
+    checksum = google_crc32c.Checksum()
+
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            checksum.update(chunk)
+
+    return base64.b64encode(checksum.digest()).decode("utf-8")
+
+
+def _diff_manifests(src_manifest, dest_manifest, local_root):
+    """Compare ``(size, crc32c)`` manifests of a sync source and destination
+
+    One of the manifests describes files on GCS and the other local files
+    below ``local_root``. Files of equal size are compared by checksum, which
+    is computed for the local copy.
+
+    Returns
+    -------
+    changed : list of str
+        Files missing from the destination or whose size or checksum differs
+    extra : list of str
+        Files on the destination which are not on the source
+    """
+    changed = []
+    for rel, (size, crc32c) in src_manifest.items():
+        if rel not in dest_manifest:
+            changed.append(rel)
+            continue
+
+        dest_size, dest_crc32c = dest_manifest[rel]
+        if size != dest_size:
+            changed.append(rel)
+            continue
+
+        remote_crc32c = dest_crc32c if crc32c is None else crc32c
+        if _file_crc32c(join(local_root, rel)) != remote_crc32c:
+            changed.append(rel)
+
+    extra = [rel for rel in dest_manifest if rel not in src_manifest]
+
+    return changed, extra
+
+
+def _upload_file(bucket, local, remote, multipart_slots=None):
+    blob = bucket.blob(remote)
+
+    if multipart_slots is None:
+        multipart_slots = threading.BoundedSemaphore(MULTIPART_MAX_FILES)
+
+    if os.path.getsize(local) > MULTIPART_THRESHOLD:
+        with multipart_slots:
+            logger.debug(
+                "Uploading %s in chunks of %d bytes", local, MULTIPART_CHUNKSIZE
+            )
+            transfer_manager.upload_chunks_concurrently(
+                local,
+                blob,
+                chunk_size=MULTIPART_CHUNKSIZE,
+                worker_type=transfer_manager.THREAD,
+                max_workers=MULTIPART_MAX_CONCURRENCY,
+                retry=DEFAULT_RETRY,
+            )
+    else:
+        # send the checksum with the object metadata so that GCS rejects a
+        # corrupted upload, instead of the client library recomputing it
+        blob.crc32c = _file_crc32c(local)
+        blob.upload_from_filename(local, checksum=None, retry=DEFAULT_RETRY)
+
+
+def _download_file(bucket, remote, local):
+    local_dir = os.path.dirname(local)
+    if local_dir:
+        os.makedirs(local_dir, exist_ok=True)
+
+    bucket.blob(remote).download_to_filename(
+        local, checksum="crc32c", retry=DEFAULT_RETRY
+    )
+
+
+def _transfer_paths(func, bucket, src, dest):
+    """Return the source and destination of a transfer task as full paths"""
+    if func is _upload_file:
+        return src, f"gs://{bucket.name}/{dest}"
+    return f"gs://{bucket.name}/{src}", dest
+
+
+def _read_transfer_log(log_path):
+    """Return the destinations of transfers recorded as successful"""
+    if log_path is None or not exists(log_path):
+        return set()
+
+    entries = []
+    with open(log_path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # e.g. the last line, if writing it was interrupted by a crash
+                logger.warning("Skipping invalid line in %s: %r", log_path, line)
+
+    return {e["name"] for e in entries if e["status"] == "ok"}
+
+
+def _write_transfer_log(log_path, entry):
+    # reopen the file for each entry so that the log survives a crash
+    with open(log_path, "ab+") as f:
+        # start a new line if the last entry was only partially written
+        if f.tell() > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                f.write(b"\n")
+        f.write((json.dumps(entry) + "\n").encode())
+
+
+def _run_transfers(
+    tasks, batch_size=None, max_concurrent_batches=None, log_path=None, resume=True
+):
+    """Run ``(func, bucket, src, dest)`` transfer tasks on a thread pool
+
+    The files in each batch of ``batch_size`` tasks are transferred
+    concurrently, and a new batch is started when the oldest of the
+    ``max_concurrent_batches`` batches in flight has finished. These default
+    to ``BATCH_SIZE`` and ``MAX_CONCURRENT_BATCHES``.
+
+    If ``log_path`` is given, the result of each transfer is appended to it as
+    a line of JSON. If ``resume`` is True, transfers already recorded in the
+    log as successful are skipped. All tasks are attempted before the first
+    error, if any, is raised.
+
+    Returns
+    -------
+    str
+        One line per transferred file
+    """
+    completed = _read_transfer_log(log_path) if resume else set()
+    if completed:
+        n_tasks = len(tasks)
+        tasks = [t for t in tasks if _transfer_paths(*t)[1] not in completed]
+        logger.info(
+            "Skipping %d files already copied according to %s",
+            n_tasks - len(tasks),
+            log_path,
+        )
+
+    batch_size = batch_size or BATCH_SIZE
+    max_concurrent_batches = max_concurrent_batches or MAX_CONCURRENT_BATCHES
+
+    lines = []
+    errors = []
+    progress = tqdm(total=len(tasks), desc="copying", disable=None)
+
+    def collect(batch):
+        for future in concurrent.futures.as_completed(batch):
+            progress.update()
+            func, _, task_src, task_dest = task = batch[future]
+            src, dest = _transfer_paths(*task)
+            local = task_src if func is _upload_file else task_dest
+
+            try:
+                future.result()
+            except Exception as e:
+                logger.error("Failed to copy %s to %s: %s", src, dest, e)
+                entry = {"name": dest, "status": "error", "error": str(e)}
+                errors.append(e)
+            else:
+                logger.info("Copied %s to %s", src, dest)
+                size = os.path.getsize(local)
+                entry = {"name": dest, "size": size, "status": "ok"}
+                lines.append(f"Copied {src} to {dest}")
+
+            if log_path is not None:
+                _write_transfer_log(log_path, entry)
+
+    # shared by the uploads to bound the number of files uploaded in chunks
+    multipart_slots = threading.BoundedSemaphore(MULTIPART_MAX_FILES)
+
+    def submit(func, *args):
+        if func is _upload_file:
+            return executor.submit(func, *args, multipart_slots=multipart_slots)
+        return executor.submit(func, *args)
+
+    max_workers = batch_size * max_concurrent_batches
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = collections.deque()
+
+        for i, batch in enumerate(_chunked(tasks, batch_size)):
+            if len(in_flight) >= max_concurrent_batches:
+                collect(in_flight.popleft())
+
+            logger.debug("Starting batch %d of %d files", i, len(batch))
+            in_flight.append({submit(*task): task for task in batch})
+
+        while in_flight:
+            collect(in_flight.popleft())
+
+    progress.close()
+
+    if errors:
+        raise errors[0]
+
+    return "\n".join(lines)
+
+
+def _check_flags(flags, supported):
+    """Raise if ``flags`` include gsutil flags the storage API paths ignore"""
+    unsupported = [f for f in flags if f not in supported]
+    if unsupported:
+        raise ValueError(
+            f"flags {unsupported} are not supported by the storage API. "
+            "Use gsutil for these flags"
+        )
+
+
+def _check_sync_source(src, src_manifest, delete):
+    """Refuse to sync from a missing or empty source
+
+    The manifest of a missing source is empty, so syncing from a misspelled
+    path would otherwise delete everything on the destination.
+    """
+    if not src.startswith("gs://") and not isdir(src):
+        raise ValueError(f"{src} is not a directory")
+
+    if delete and not src_manifest:
+        raise ValueError(
+            f"{src} is empty or does not exist. Refusing to delete all files on "
+            "the destination"
+        )
+
+
+def _cp_tasks(client, src, dest, recursive=False):
+    """Plan the file transfers made by ``gsutil cp`` with the storage API"""
+    if not src.startswith("gs://") and dest.startswith("gs://"):
+        bucket_name, dest_name = _parse_gs_url(dest)
+        bucket = client.bucket(bucket_name)
+        dest_isdir = _gcs_isdir(client, bucket_name, dest_name)
+
+        if isdir(src):
+            if not recursive:
+                raise ValueError(f"{src} is a directory. Use flags=['r'] to copy it")
+            if dest_isdir:
+                dest_name = _join_blob(dest_name, basename(src.rstrip("/")))
+            return [
+                (_upload_file, bucket, join(src, rel), _join_blob(dest_name, rel))
+                for rel in _local_manifest(src)
+            ]
+
+        if dest_isdir or dest_name.endswith("/"):
+            dest_name = _join_blob(dest_name, basename(src))
+        return [(_upload_file, bucket, src, dest_name)]
+
+    if src.startswith("gs://") and not dest.startswith("gs://"):
+        bucket_name, src_name = _parse_gs_url(src)
+        bucket = client.bucket(bucket_name)
+
+        if recursive:
+            manifest = _gcs_manifest(client, bucket_name, src_name)
+            if manifest:
+                if isdir(dest):
+                    dest = join(dest, basename(src_name.rstrip("/")))
+                return [
+                    (_download_file, bucket, _join_blob(src_name, rel), join(dest, rel))
+                    for rel in manifest
+                ]
+
+        if isdir(dest):
+            dest = join(dest, basename(src_name))
+        return [(_download_file, bucket, src_name, dest)]
+
+    raise ValueError("The storage API can only copy between local paths and GCS")
+
+
+def _sync_api(
+    client,
+    src,
+    dest,
+    recursive=True,
+    delete=False,
+    batch_size=None,
+    max_concurrent_batches=None,
+    log_path=None,
+):
+    """Reproduce ``gsutil rsync`` with the storage API
+
+    Files are transferred if they are missing from ``dest`` or differ in size
+    or CRC32C checksum. Like ``gsutil rsync``, raises ``ValueError`` if a local
+    ``src`` is not a directory, or if ``delete`` is set and ``src`` is empty.
+
+    Returns
+    -------
+    str
+        One line per transferred or removed file
+    """
+    if not src.startswith("gs://") and dest.startswith("gs://"):
+        bucket_name, prefix = _parse_gs_url(dest)
+        bucket = client.bucket(bucket_name)
+        src_manifest = _local_manifest(src, recursive=recursive)
+        _check_sync_source(src, src_manifest, delete)
+        dest_manifest = _gcs_manifest(client, bucket_name, prefix, recursive)
+        local_root = src
+
+        def task(rel):
+            return (_upload_file, bucket, join(src, rel), _join_blob(prefix, rel))
+
+    elif src.startswith("gs://") and not dest.startswith("gs://"):
+        bucket_name, prefix = _parse_gs_url(src)
+        bucket = client.bucket(bucket_name)
+        src_manifest = _gcs_manifest(client, bucket_name, prefix, recursive)
+        _check_sync_source(src, src_manifest, delete)
+        dest_manifest = _local_manifest(dest, recursive=recursive)
+        local_root = dest
+
+        def task(rel):
+            return (_download_file, bucket, _join_blob(prefix, rel), join(dest, rel))
+
+    else:
+        raise ValueError("The storage API can only sync between local paths and GCS")
+
+    changed, extra = _diff_manifests(src_manifest, dest_manifest, local_root)
+    tasks = [task(rel) for rel in changed]
+
+    lines = []
+    if tasks:
+        lines.append(
+            _run_transfers(
+                tasks,
+                batch_size=batch_size,
+                max_concurrent_batches=max_concurrent_batches,
+                log_path=log_path,
+                # the manifest diff already skips files which were copied
+                resume=False,
+            )
+        )
+
+    if delete:
+        if dest.startswith("gs://"):
+            blobs = (bucket.blob(_join_blob(prefix, rel)) for rel in extra)
+            for chunk in _chunked(blobs, BATCH_DELETE_SIZE):
+                _delete_blob_batch(client, chunk)
+            lines += [
+                f"Removed gs://{bucket_name}/{_join_blob(prefix, rel)}" for rel in extra
+            ]
+        else:
+            for rel in extra:
+                os.remove(join(dest, rel))
+            lines += [f"Removed {join(dest, rel)}" for rel in extra]
+
+    return "\n".join(lines)
+
+
+def _is_local_dir(path):
+    """Check whether ``path`` is a local directory, without touching gcsfuse"""
+    return not path.startswith("gs://") and isdir(path)
+
+
+def _make_gcsfuse_dirs(src, dest):
+    """Recreate the directory tree below local ``src`` at ``dest`` on gcsfuse
+
+    Only leaf directories are created, since ``os.makedirs`` creates their
+    parents.
+    """
+    for d, dirnames, _ in os.walk(src):
+        if not dirnames:
+            os.makedirs(join(dest, os.path.relpath(d, src)), exist_ok=True)
+
+
+def cp(
+    src,
+    dest,
+    flags=[],
+    use_api=False,
+    client=None,
+    batch_size=None,
+    max_concurrent_batches=None,
+    gcsfuse_dirs=False,
+    log_path=None,
+):
     """Copy a file or recursively copy a directory from local
     path to GCS or vice versa. Must have already authenticated to use.
     Notebook servers are automatically authenticated, but workers
@@ -204,11 +944,44 @@ def cp(src, dest, flags=[]):
         String of flags to add to the gsutil cp command. e.g.
         `flags=['r']` will run the command `gsutil -m cp -r...`
         (recursive copy)
+    use_api : bool, optional
+        Copy files with the google cloud storage python API in this process
+        rather than calling `gsutil`. Only copies between a local path and
+        GCS, and only the `r` flag, are supported in this mode. Other flags
+        raise a ``ValueError``. Default False.
+    client : google.cloud.storage.client.Client or None, optional
+        Authenticated client used when ``use_api=True`` or
+        ``gcsfuse_dirs=True``. If None (default) a client is created with
+        :py:func:`authenticated_client`.
+    batch_size : int or None, optional
+        Number of files per batch when ``use_api=True``. The files in a batch
+        are transferred concurrently. Defaults to ``BATCH_SIZE`` (16), which
+        is set by the ``RHG_GCS_BATCH_SIZE`` environment variable.
+    max_concurrent_batches : int or None, optional
+        Number of batches in flight at once when ``use_api=True``. Defaults
+        to ``MAX_CONCURRENT_BATCHES`` (4), which is set by the
+        ``RHG_GCS_MAX_CONCURRENT_BATCHES`` environment variable.
+        Uploads of files larger than ``MULTIPART_THRESHOLD`` bytes are
+        additionally split into chunks which are uploaded in parallel, one
+        file at a time by default. The thresholds can be set with the
+        ``RHG_GCS_MULTIPART_THRESHOLD``, ``RHG_GCS_MULTIPART_CHUNKSIZE``,
+        ``RHG_GCS_MULTIPART_MAX_CONCURRENCY`` and
+        ``RHG_GCS_MULTIPART_MAX_FILES`` environment variables.
+    gcsfuse_dirs : bool, optional
+        After recursively copying a directory to GCS, create its directories
+        through the gcsfuse mount at `/gcs` so that gcsfuse recognizes them.
+        Default False.
+    log_path : str or None, optional
+        Path to a file to which the outcome of each transfer is appended as a
+        line of JSON when ``use_api=True``. Files recorded as copied are
+        skipped, so an interrupted copy can be resumed by repeating the call
+        with the same ``log_path``. Default None.
 
     Returns
     -------
     str
-        stdout from gsutil call
+        stdout from gsutil call, or the list of copied files if
+        ``use_api=True``
     str
         stderr from gsutil call
     :py:class:`datetime.timedelta`
@@ -225,37 +998,116 @@ def cp(src, dest, flags=[]):
     # then these won't change anything
     src_gs, src_gcs, dest_gs, dest_gcs = _get_path_types(src, dest)
 
-    # if directory already existed cp would put src into dest_gcs
-    if exists(dest_gcs):
-        dest_base = join(dest_gcs, basename(src))
-    # else cp would have put the contents of src into the new directory
-    else:
-        dest_base = dest_gcs
-
-    cmd = (
-        "gsutil -m cp "
-        + " ".join(["-" + f for f in flags])
-        + " {} {}".format(src_gs, dest_gs)
+    make_dirs = (
+        gcsfuse_dirs and dest_gcs.startswith("/gcs/") and _is_local_dir(src_gs)
     )
 
-    print(f"Running cmd: {cmd}")
-    cmd = shlex.split(cmd)
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout, stderr = p.communicate()
+    if make_dirs:
+        if client is None:
+            client = authenticated_client()
+
+        # if directory already existed cp would put src into dest_gcs. Check
+        # with the storage API rather than stat-ing the path through gcsfuse.
+        bucket_name, dest_name = _parse_gs_url(dest_gs)
+        if _gcs_isdir(client, bucket_name, dest_name):
+            dest_base = join(dest_gcs, basename(src))
+        # else cp would have put the contents of src into the new directory
+        else:
+            dest_base = dest_gcs
+
+    if use_api:
+        _check_flags(flags, ["r"])
+
+        if client is None:
+            client = authenticated_client()
+
+        tasks = _cp_tasks(client, src_gs, dest_gs, recursive=("r" in flags))
+        stdout = _run_transfers(
+            tasks,
+            batch_size=batch_size,
+            max_concurrent_batches=max_concurrent_batches,
+            log_path=log_path,
+        )
+        stderr = ""
+
+    else:
+        cmd = ["gsutil", "-m", "cp", *_flag_args(flags), src_gs, dest_gs]
+
+        print(f"Running cmd: {_format_cmd(cmd)}")
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = p.communicate()
 
     # need to add directories if you were recursively copying a directory
-    if isdir(src_gcs) and dest_gcs.startswith("/gcs/"):
+    if make_dirs:
         # now make directory blobs on gcs so that gcsfuse recognizes it
-        dirs_to_make = [x[0].replace(src, dest_base) for x in os.walk(src)]
-        for d in dirs_to_make:
-            os.makedirs(d, exist_ok=True)
+        _make_gcsfuse_dirs(src, dest_base)
 
     end_time = dt.now()
 
     return stdout, stderr, end_time - st_time
 
 
-def sync(src, dest, flags=["r", "d"]):
+def cp_many(srcs, dest, flags=[]):
+    """Copy many files or directories to a single destination with one call
+    to `gsutil`.
+
+    The source paths are passed to ``gsutil -m cp -I`` on stdin, so the cost
+    of starting `gsutil` and authenticating is paid once rather than once per
+    file as when calling :py:func:`cp` in a loop. Must have already
+    authenticated to use.
+
+    Parameters
+    ----------
+    srcs : list of str or :class:`pathlib.Path`
+        The paths to the source files or directories. If on GCS, either the
+        `/gcs` or `gs:/` prefix will work.
+    dest : str
+        The destination directory. If on GCS, either the `/gcs` or `gs:/`
+        prefix will work.
+    flags : list of str, optional
+        String of flags to add to the gsutil cp command. e.g.
+        `flags=['r']` will run the command `gsutil -m cp -r -I ...`
+        (recursive copy)
+
+    Returns
+    -------
+    str
+        stdout from gsutil call
+    str
+        stderr from gsutil call
+    :py:class:`datetime.timedelta`
+        Time it took to copy file(s).
+    """
+
+    st_time = dt.now()
+
+    srcs = [_to_gs(str(src)) for src in srcs]
+    dest_gs = _to_gs(str(dest))
+
+    cmd = ["gsutil", "-m", "cp", *_flag_args(flags), "-I", dest_gs]
+
+    print(f"Running cmd: {_format_cmd(cmd)}")
+    p = subprocess.Popen(
+        cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    stdout, stderr = p.communicate("\n".join(srcs).encode())
+
+    end_time = dt.now()
+
+    return stdout, stderr, end_time - st_time
+
+
+def sync(
+    src,
+    dest,
+    flags=["r", "d"],
+    use_api=False,
+    client=None,
+    batch_size=None,
+    max_concurrent_batches=None,
+    gcsfuse_dirs=False,
+    log_path=None,
+):
     """Sync a directory from local to GCS or vice versa. Uses `gsutil rsync`.
     Must have already authenticated to use. Notebook servers
     are automatically authenticated, but workers need to pass the path
@@ -273,11 +1125,38 @@ def sync(src, dest, flags=["r", "d"]):
         `flags=['r','d']` will run the command `gsutil -m cp -r -d...`
         (recursive copy, delete any files on dest that are not on src).
         This is the default set of flags.
+    use_api : bool, optional
+        Sync files with the google cloud storage python API in this process
+        rather than calling `gsutil`. Files are copied if they are missing
+        from `dest` or differ in size or CRC32C checksum. Only syncs between
+        a local directory and GCS, and only the `r` and `d` flags, are
+        supported in this mode. Other flags raise a ``ValueError``, as does a
+        missing source, or an empty one when deleting. Default False.
+    client : google.cloud.storage.client.Client or None, optional
+        Authenticated client used when ``use_api=True``. If None (default)
+        a client is created with :py:func:`authenticated_client`.
+    batch_size : int or None, optional
+        Number of files per batch when ``use_api=True``. The files in a batch
+        are transferred concurrently. Defaults to ``BATCH_SIZE`` (16), which
+        is set by the ``RHG_GCS_BATCH_SIZE`` environment variable.
+    max_concurrent_batches : int or None, optional
+        Number of batches in flight at once when ``use_api=True``. Defaults
+        to ``MAX_CONCURRENT_BATCHES`` (4), which is set by the
+        ``RHG_GCS_MAX_CONCURRENT_BATCHES`` environment variable.
+    gcsfuse_dirs : bool, optional
+        After syncing to GCS, create the directories of `src` through the
+        gcsfuse mount at `/gcs` so that gcsfuse recognizes them. Default False.
+    log_path : str or None, optional
+        Path to a file to which the outcome of each transfer is appended as a
+        line of JSON when ``use_api=True``. Unlike :py:func:`cp`, files are not
+        skipped based on the log, since files which are already up to date
+        are skipped by comparing checksums. Default None.
 
     Returns
     -------
     str
-        stdout from gsutil call
+        stdout from gsutil call, or the list of copied and removed files if
+        ``use_api=True``
     str
         stderr from gsutil call
     :py:class:`datetime.timedelta`
@@ -298,24 +1177,35 @@ def sync(src, dest, flags=["r", "d"]):
     # then these won't change anything
     src_gs, src_gcs, dest_gs, dest_gcs = _get_path_types(src, dest)
 
-    cmd = (
-        "gsutil -m rsync "
-        + " ".join(["-" + f for f in flags])
-        + " {} {}".format(src_gs, dest_gs)
-    )
+    if use_api:
+        _check_flags(flags, ["r", "d"])
+
+        if client is None:
+            client = authenticated_client()
+
+        stdout = _sync_api(
+            client,
+            src_gs,
+            dest_gs,
+            recursive=("r" in flags),
+            delete=("d" in flags),
+            batch_size=batch_size,
+            max_concurrent_batches=max_concurrent_batches,
+            log_path=log_path,
+        )
+        stderr = ""
 
-    print(f"Running cmd: {cmd}")
+    else:
+        cmd = ["gsutil", "-m", "rsync", *_flag_args(flags), src_gs, dest_gs]
 
-    cmd = shlex.split(cmd)
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout, stderr = p.communicate()
+        print(f"Running cmd: {_format_cmd(cmd)}")
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = p.communicate()
 
     # need to add directories if you were recursively copying a directory TO
     # gcs now make directory blobs on gcs so that gcsfuse recognizes it
-    if dest_gcs.startswith("/gcs/"):
-        dirs_to_make = [x[0].replace(src_gcs, dest_gcs) for x in os.walk(src_gcs)]
-        for d in dirs_to_make:
-            os.makedirs(d, exist_ok=True)
+    if gcsfuse_dirs and dest_gcs.startswith("/gcs/") and _is_local_dir(src_gs):
+        _make_gcsfuse_dirs(src_gs, dest_gcs)
 
     end_time = dt.now()
 
@@ -325,12 +1215,11 @@ def sync(src, dest, flags=["r", "d"]):
 def ls(dir_path):
     """List a directory quickly using `gsutil`"""
 
-    dir_url = str(dir_path).replace("/gcs/", "gs://")
+    dir_url = _to_gs(str(dir_path))
 
-    cmd = f"gsutil ls {dir_url}"
+    cmd = ["gsutil", "ls", dir_url]
 
-    print(f"Running cmd: {cmd}")
-    cmd = shlex.split(cmd)
+    print(f"Running cmd: {_format_cmd(cmd)}")
     p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     stdout, stderr = p.communicate()
 
@@ -350,7 +1239,7 @@ def _fetch_dirs(bucket, prefix=None):
     """
     all_dirs = set([])
 
-    for blob in bucket.list_blobs(prefix=prefix):
+    for blob in bucket.list_blobs(prefix=prefix, fields=_DIRS_LIST_FIELDS):
         p = Path(blob.name).parent
 
         # Skip root dir.
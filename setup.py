@@ -14,7 +14,8 @@ with open("HISTORY.rst") as history_file:
     history = re.sub(r"\(:issue:`[0-9]+`\)", "", history_file.read())
 
 requirements = [
-    "google-cloud-storage",
+    "google-cloud-storage>=2.14",
+    "google-crc32c",
     "click",
     "dask-gateway",
     "pandas",
@@ -40,6 +41,7 @@ setup(
         "rhg_compute_tools": ["*.mplstyle"],
     },
     install_requires=requirements,
+    extras_require={"aio": ["gcloud-aio-storage"]},
     license="MIT license",
     zip_safe=False,
     keywords="rhg_compute_tools",
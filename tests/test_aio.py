@@ -0,0 +1,117 @@
+"""
+Tests for `rhg_compute_tools.aio` using a mocked `gcloud.aio.storage.Storage`
+"""
+
+import pytest
+
+pytest.importorskip("gcloud.aio.storage")
+
+from aiohttp import ClientResponseError
+
+from rhg_compute_tools import aio
+
+
+class MockStorage:
+    def __init__(self, objects):
+        # {name: {"size": str, "crc32c": str}}
+        self.objects = objects
+        self.uploads = []
+        self.deletes = []
+        self.statuses = []
+
+    def __call__(self, service_file=None):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def list_objects(self, bucket, params=None):
+        prefix = params.get("prefix", "")
+        names = sorted(n for n in self.objects if n.startswith(prefix))
+
+        start = int(params.get("pageToken", 0))
+        end = start + int(params["maxResults"])
+        items = [dict(name=n, **self.objects[n]) for n in names[start:end]]
+        response = {"items": items}
+        if end < len(names):
+            response["nextPageToken"] = str(end)
+        return response
+
+    async def upload_from_filename(self, bucket, name, filename):
+        self.uploads.append((filename, name))
+
+    async def delete(self, bucket, name):
+        self.deletes.append(name)
+        if self.statuses:
+            raise ClientResponseError(None, (), status=self.statuses.pop(0))
+
+
+@pytest.fixture(autouse=True)
+def one_object_per_page(monkeypatch):
+    # exercise pagination
+    monkeypatch.setattr(aio, "LIST_PAGE_SIZE", 1)
+
+
+@pytest.fixture
+def no_sleep(monkeypatch):
+    async def sleep(delay):
+        pass
+
+    monkeypatch.setattr(aio.asyncio, "sleep", sleep)
+
+
+def test_sync(tmpdir, monkeypatch):
+    tmpdir.join("same.txt").write("1234")
+    tmpdir.join("new.txt").write("1")
+    storage = MockStorage(
+        {
+            # crc32c of b"1234"
+            "dir/same.txt": {"size": "4", "crc32c": "9jr07g=="},
+            "dir/old.txt": {"size": "4", "crc32c": "9jr07g=="},
+        }
+    )
+    monkeypatch.setattr(aio, "Storage", storage)
+
+    aio.sync(str(tmpdir), "/gcs/bucket/dir")
+
+    assert storage.uploads == [(str(tmpdir.join("new.txt")), "dir/new.txt")]
+    assert storage.deletes == ["dir/old.txt"]
+
+
+def test_rm(monkeypatch):
+    storage = MockStorage({n: {} for n in ["dir/a", "dir/b/c", "other"]})
+    monkeypatch.setattr(aio, "Storage", storage)
+
+    stdout, _, _ = aio.rm("gs://bucket/dir", flags=["r"])
+
+    assert sorted(storage.deletes) == ["dir/a", "dir/b/c"]
+    assert stdout.splitlines() == [
+        "Removed gs://bucket/dir/a",
+        "Removed gs://bucket/dir/b/c",
+    ]
+
+
+def test_rm_retries_transient_errors(monkeypatch, no_sleep):
+    storage = MockStorage({"dir/a": {}})
+    storage.statuses = [503, 429]
+    monkeypatch.setattr(aio, "Storage", storage)
+
+    stdout, _, _ = aio.rm("gs://bucket/dir", flags=["r"])
+
+    assert storage.deletes == ["dir/a"] * 3
+    assert stdout == "Removed gs://bucket/dir/a"
+
+
+def test_sync_refuses_missing_source(tmpdir, monkeypatch):
+    storage = MockStorage({"dir/a": {"size": "4", "crc32c": "9jr07g=="}})
+    monkeypatch.setattr(aio, "Storage", storage)
+
+    with pytest.raises(ValueError):
+        aio.sync(str(tmpdir.join("missing")), "gs://bucket/dir")
+    with pytest.raises(ValueError):
+        aio.sync("gs://bucket/typo", str(tmpdir))
+
+    assert storage.deletes == []
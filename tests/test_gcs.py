@@ -0,0 +1,611 @@
+"""
+Tests for the google cloud storage API code paths in `rhg_compute_tools.gcs`
+"""
+
+import base64
+import json
+import os
+import threading
+import time
+
+import google_crc32c
+import pytest
+import requests
+from google.api_core import exceptions
+
+from rhg_compute_tools import gcs
+
+
+def crc32c(data):
+    return base64.b64encode(google_crc32c.Checksum(data).digest()).decode()
+
+
+def mock_response(status_code):
+    response = requests.Response()
+    response.status_code = status_code
+    response.request = requests.Request(method="DELETE", url="batch://")
+    return response
+
+
+class MockBatch:
+    def __init__(self, client):
+        self._client = client
+        self.queued = []
+
+    def finish(self, raise_exception=True):
+        assert not raise_exception
+        with self._client.lock:
+            self._client.batch_requests += 1
+            if self._client.batch_errors:
+                raise self._client.batch_errors.pop(0)
+            if self._client.statuses:
+                statuses = self._client.statuses.pop(0)
+            else:
+                statuses = [204] * len(self.queued)
+        return [mock_response(s) for s in statuses]
+
+
+class MockBlob:
+    def __init__(self, client, name, generation=1, size=0, crc32c=None):
+        self._client = client
+        self.name = name
+        self.generation = generation
+        self.size = size
+        self.crc32c = crc32c
+
+    def upload_from_filename(self, filename, **kwargs):
+        assert kwargs["retry"] is gcs.DEFAULT_RETRY
+        with self._client.lock:
+            self._client.uploads.append((filename, self.name))
+            self._client.checksums[self.name] = self.crc32c
+
+    def download_to_filename(self, filename, **kwargs):
+        assert kwargs["retry"] is gcs.DEFAULT_RETRY
+        with open(filename, "w") as f:
+            f.write(self.name)
+        with self._client.lock:
+            self._client.downloads.append((self.name, filename))
+
+    def delete(self, **kwargs):
+        assert kwargs["if_generation_match"] == self.generation
+        self._client.local.batch.queued.append(self.name)
+        with self._client.lock:
+            self._client.calls.append(self.name)
+
+
+class MockBucket:
+    def __init__(self, client, name):
+        self._client = client
+        self.name = name
+
+    def blob(self, name):
+        return MockBlob(self._client, name)
+
+
+class MockIterator:
+    def __init__(self, items, page_size=None):
+        self.items = items
+        self.page_size = page_size or len(items) or 1
+
+    def __iter__(self):
+        return iter(self.items)
+
+    @property
+    def pages(self):
+        for i in range(0, len(self.items), self.page_size):
+            yield iter(self.items[i : i + self.page_size])
+
+
+class MockClient:
+    def __init__(self, names, statuses=()):
+        # names may be given as (name, size, crc32c) tuples
+        names = [n if isinstance(n, tuple) else (n, 0, None) for n in names]
+        self.blobs = [
+            MockBlob(self, n, size=size, crc32c=crc32c) for n, size, crc32c in names
+        ]
+        self.statuses = list(statuses)
+        self.batch_errors = []
+        self.batch_requests = 0
+        self.calls = []
+        self.uploads = []
+        self.checksums = {}
+        self.downloads = []
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def batch(self, raise_exception=True):
+        return MockBatch(self)
+
+    def _push_batch(self, batch):
+        self.local.batch = batch
+
+    def _pop_batch(self):
+        return self.local.__dict__.pop("batch")
+
+    def bucket(self, name):
+        return MockBucket(self, name)
+
+    def list_blobs(
+        self, bucket_name, prefix=None, max_results=None, page_size=None, **kwargs
+    ):
+        # partial responses must include the token for the next page
+        if "fields" in kwargs and max_results is None:
+            assert "nextPageToken" in kwargs["fields"]
+
+        blobs = [b for b in self.blobs if b.name.startswith(prefix or "")]
+        return MockIterator(blobs[:max_results], page_size=page_size)
+
+
+@pytest.fixture
+def no_sleep(mocker):
+    mocker.patch.object(gcs.time, "sleep")
+
+
+def test_rm_batch_retries_transient_errors(no_sleep):
+    client = MockClient(["dir/a", "dir/b", "dir/c"], [[204, 503, 404], [204]])
+
+    stdout, stderr, _ = gcs.rm(
+        "gs://bucket/dir", flags=["r"], use_batch=True, client=client
+    )
+
+    assert client.calls == ["dir/a", "dir/b", "dir/c", "dir/b"]
+    assert stdout.splitlines() == [
+        "Removed gs://bucket/dir/a",
+        "Removed gs://bucket/dir/c",
+        "Removed gs://bucket/dir/b",
+    ]
+
+
+def test_rm_batch_raises_on_permanent_error(no_sleep):
+    client = MockClient(["dir/a"], [[403]])
+
+    with pytest.raises(exceptions.Forbidden):
+        gcs.rm("/gcs/bucket/dir", flags=["r"], use_batch=True, client=client)
+
+
+def test_rm_batch_threads(no_sleep):
+    names = [f"dir/{i}" for i in range(2500)]
+    client = MockClient(names, [])
+
+    stdout, _, _ = gcs.rm(
+        "gs://bucket/dir/", flags=["r"], use_batch=True, client=client, threads=4
+    )
+
+    assert sorted(client.calls) == sorted(names)
+    assert len(stdout.splitlines()) == 2500
+
+
+def test_cp_api_uploads_directory(tmpdir):
+    tmpdir.mkdir("data").mkdir("sub").join("b.txt").write("b")
+    tmpdir.join("data").join("a.txt").write("a")
+    src = str(tmpdir.join("data"))
+    client = MockClient(["existing/c.txt"])
+
+    gcs.cp(src, "/gcs/bucket/existing", flags=["r"], use_api=True, client=client)
+
+    assert sorted(client.uploads) == [
+        (os.path.join(src, "a.txt"), "existing/data/a.txt"),
+        (os.path.join(src, "sub/b.txt"), "existing/data/sub/b.txt"),
+    ]
+
+
+def test_cp_api_requires_recursive_flag_for_directories(tmpdir):
+    with pytest.raises(ValueError):
+        gcs.cp(str(tmpdir), "gs://bucket/dest", use_api=True, client=MockClient([]))
+
+
+def test_sync_api(tmpdir, no_sleep):
+    tmpdir.join("same.txt").write("1234")
+    tmpdir.join("resized.txt").write("12345")
+    tmpdir.join("edited.txt").write("abcd")
+    tmpdir.join("new.txt").write("1")
+    client = MockClient(
+        [
+            ("dir/same.txt", 4, crc32c(b"1234")),
+            ("dir/resized.txt", 4, crc32c(b"1234")),
+            ("dir/edited.txt", 4, crc32c(b"1234")),
+            "dir/old.txt",
+        ]
+    )
+
+    stdout, _, _ = gcs.sync(str(tmpdir), "gs://bucket/dir", use_api=True, client=client)
+
+    assert sorted(client.uploads) == [
+        (str(tmpdir.join("edited.txt")), "dir/edited.txt"),
+        (str(tmpdir.join("new.txt")), "dir/new.txt"),
+        (str(tmpdir.join("resized.txt")), "dir/resized.txt"),
+    ]
+    assert client.checksums["dir/new.txt"] == crc32c(b"1")
+    assert client.calls == ["dir/old.txt"]
+    assert "Removed gs://bucket/dir/old.txt" in stdout.splitlines()
+
+
+def test_cp_api_uploads_large_files_in_chunks(tmpdir, mocker):
+    tmpdir.join("large.bin").write("0" * 10)
+    tmpdir.join("small.bin").write("0")
+    mocker.patch.object(gcs, "MULTIPART_THRESHOLD", 5)
+    chunked = mocker.patch.object(gcs.transfer_manager, "upload_chunks_concurrently")
+    client = MockClient([])
+
+    gcs.cp(str(tmpdir), "gs://bucket/dest", flags=["r"], use_api=True, client=client)
+
+    assert chunked.call_count == 1
+    assert chunked.call_args[0][0] == str(tmpdir.join("large.bin"))
+    assert client.uploads == [(str(tmpdir.join("small.bin")), "dest/small.bin")]
+
+
+@pytest.fixture
+def client_cache():
+    # don't leak clients created with mocks into other tests
+    gcs.authenticated_client.cache_clear()
+    yield
+    gcs.authenticated_client.cache_clear()
+
+
+def test_authenticated_client_is_cached(mocker, client_cache):
+    mocker.patch.object(gcs.storage, "Client", side_effect=lambda **kw: object())
+
+    client = gcs.authenticated_client()
+    assert gcs.authenticated_client() is client
+    assert gcs.storage.Client.call_count == 1
+
+    gcs.authenticated_client.cache_clear()
+    assert gcs.authenticated_client() is not client
+
+
+def test_authenticated_client_unhashable_kwargs(mocker, client_cache):
+    mocker.patch.object(gcs.storage, "Client", side_effect=lambda **kw: object())
+    mocker.patch.object(gcs.service_account.Credentials, "from_service_account_file")
+
+    options = {"api_endpoint": "https://storage.example.com"}
+    client = gcs.authenticated_client("creds.json", client_options=options)
+
+    assert gcs.authenticated_client("creds.json", client_options=options) is not client
+    gcs.storage.Client.assert_called_with(
+        credentials=mocker.ANY, client_options=options
+    )
+
+
+def test_make_gcsfuse_dirs(tmpdir):
+    src = tmpdir.mkdir("src")
+    src.mkdir("a").mkdir("b")
+    src.mkdir("c")
+    dest = tmpdir.join("dest")
+
+    gcs._make_gcsfuse_dirs(str(src), str(dest))
+
+    assert dest.join("a").join("b").isdir()
+    assert dest.join("c").isdir()
+
+
+@pytest.mark.parametrize(
+    "text,prefix,expected",
+    [
+        ("/gcs/rhg-data/a/b", "/gcs/rhg-data/", "a/b"),
+        ("/gcs/other/a/b", "/gcs/rhg-data/", "/gcs/other/a/b"),
+        ("/gcs/rhg-data/a/b", "", "/gcs/rhg-data/a/b"),
+    ],
+)
+def test_remove_prefix(text, prefix, expected):
+    assert gcs._remove_prefix(text, prefix) == expected
+
+
+def test_get_path_types():
+    assert gcs._get_path_types("/gcs/bucket/gcs/a", "gs://bucket/b") == (
+        "gs://bucket/gcs/a",
+        "/gcs/bucket/gcs/a",
+        "gs://bucket/b",
+        "/gcs/bucket/b",
+    )
+    assert gcs._get_path_types("local/a", "local/b") == (
+        "local/a",
+        "local/a",
+        "local/b",
+        "local/b",
+    )
+
+
+def test_cp_passes_paths_with_spaces_to_gsutil(mocker):
+    popen = mocker.patch.object(gcs.subprocess, "Popen")
+    popen.return_value.communicate.return_value = (b"", b"")
+
+    gcs.cp("my data/file 1.csv", "/gcs/bucket/my dir/", flags=["r"])
+
+    assert popen.call_args[0][0] == [
+        "gsutil",
+        "-m",
+        "cp",
+        "-r",
+        "my data/file 1.csv",
+        "gs://bucket/my dir/",
+    ]
+
+
+def test_sync_splits_flags_with_values(mocker):
+    popen = mocker.patch.object(gcs.subprocess, "Popen")
+    popen.return_value.communicate.return_value = (b"", b"")
+
+    gcs.sync("local", "/gcs/bucket/dest", flags=["r", "d", r'x ".*\.tmp$"'])
+
+    assert popen.call_args[0][0] == [
+        "gsutil",
+        "-m",
+        "rsync",
+        "-r",
+        "-d",
+        "-x",
+        r".*\.tmp$",
+        "local",
+        "gs://bucket/dest",
+    ]
+
+
+def test_cp_many_sends_sources_on_stdin(mocker):
+    popen = mocker.patch.object(gcs.subprocess, "Popen")
+    popen.return_value.communicate.return_value = (b"", b"")
+
+    gcs.cp_many(["a.csv", "/gcs/bucket/b.csv"], "/gcs/bucket/dest")
+
+    assert popen.call_args[0][0] == ["gsutil", "-m", "cp", "-I", "gs://bucket/dest"]
+    popen.return_value.communicate.assert_called_once_with(
+        b"a.csv\ngs://bucket/b.csv"
+    )
+
+
+def test_cp_api_resumes_from_log(tmpdir):
+    src = tmpdir.mkdir("data")
+    src.join("a.txt").write("a")
+    src.join("b.txt").write("b")
+    log_path = str(tmpdir.join("log.jsonl"))
+    tmpdir.join("log.jsonl").write(
+        json.dumps({"name": "gs://bucket/dest/a.txt", "size": 1, "status": "ok"})
+        + "\n"
+    )
+    client = MockClient([])
+
+    gcs.cp(
+        str(src),
+        "gs://bucket/dest",
+        flags=["r"],
+        use_api=True,
+        client=client,
+        log_path=log_path,
+    )
+
+    assert client.uploads == [(str(src.join("b.txt")), "dest/b.txt")]
+    with open(log_path) as f:
+        entries = [json.loads(line) for line in f]
+    assert entries[-1] == {"name": "gs://bucket/dest/b.txt", "size": 1, "status": "ok"}
+
+
+@pytest.mark.parametrize("batch_size,max_concurrent_batches", [(1, 1), (3, 2)])
+def test_cp_api_batches(tmpdir, batch_size, max_concurrent_batches):
+    for i in range(10):
+        tmpdir.join(f"{i}.txt").write(str(i))
+    client = MockClient([])
+
+    stdout, _, _ = gcs.cp(
+        str(tmpdir),
+        "gs://bucket/dest",
+        flags=["r"],
+        use_api=True,
+        client=client,
+        batch_size=batch_size,
+        max_concurrent_batches=max_concurrent_batches,
+    )
+
+    assert sorted(name for _, name in client.uploads) == [
+        f"dest/{i}.txt" for i in range(10)
+    ]
+    assert len(stdout.splitlines()) == 10
+
+
+@pytest.mark.parametrize(
+    "existing,expected_base",
+    [(["dest/x.txt"], "/gcs/bucket/dest/data"), ([], "/gcs/bucket/dest")],
+)
+def test_cp_gcsfuse_dirs_checks_dest_with_api(tmpdir, mocker, existing, expected_base):
+    src = str(tmpdir.mkdir("data"))
+    popen = mocker.patch.object(gcs.subprocess, "Popen")
+    popen.return_value.communicate.return_value = (b"", b"")
+    make_dirs = mocker.patch.object(gcs, "_make_gcsfuse_dirs")
+    exists = mocker.patch.object(gcs, "exists")
+
+    gcs.cp(
+        src,
+        "/gcs/bucket/dest",
+        flags=["r"],
+        client=MockClient(existing),
+        gcsfuse_dirs=True,
+    )
+
+    make_dirs.assert_called_once_with(src, expected_base)
+    exists.assert_not_called()
+
+
+def test_sync_skips_gcsfuse_dirs_for_remote_source(mocker):
+    popen = mocker.patch.object(gcs.subprocess, "Popen")
+    popen.return_value.communicate.return_value = (b"", b"")
+    make_dirs = mocker.patch.object(gcs, "_make_gcsfuse_dirs")
+    isdir = mocker.patch.object(gcs, "isdir", return_value=True)
+
+    gcs.sync("/gcs/bucket/src", "/gcs/bucket/dest", gcsfuse_dirs=True)
+
+    make_dirs.assert_not_called()
+    isdir.assert_not_called()
+
+
+def test_rm_batch_skips_modified_blobs(no_sleep):
+    client = MockClient(["dir/a", "dir/b"], [[204, 412]])
+
+    stdout, _, _ = gcs.rm("gs://bucket/dir", flags=["r"], use_batch=True, client=client)
+
+    assert client.calls == ["dir/a", "dir/b"]
+    assert stdout.splitlines() == ["Removed gs://bucket/dir/a"]
+
+
+@pytest.mark.parametrize("name", ["missing", "file.txt"])
+def test_sync_api_refuses_missing_local_source(tmpdir, name):
+    tmpdir.join("file.txt").write("1")
+    client = MockClient(["dir/a.txt", "dir/sub/b.txt"])
+
+    with pytest.raises(ValueError):
+        gcs.sync(str(tmpdir.join(name)), "gs://bucket/dir", use_api=True, client=client)
+
+    assert client.calls == []
+    assert client.uploads == []
+
+
+def test_sync_api_refuses_empty_source_prefix(tmpdir):
+    tmpdir.join("a.txt").write("1")
+    client = MockClient(["dir/a.txt"])
+
+    with pytest.raises(ValueError):
+        gcs.sync("gs://bucket/typo", str(tmpdir), use_api=True, client=client)
+
+    assert tmpdir.join("a.txt").check()
+
+    # without deletion there is nothing to lose
+    gcs.sync("gs://bucket/typo", str(tmpdir), flags=["r"], use_api=True, client=client)
+
+
+def test_sync_api_downloads(tmpdir):
+    tmpdir.join("same.txt").write("dir/same.txt")
+    tmpdir.join("edited.txt").write("abcd")
+    tmpdir.join("old.txt").write("1")
+    client = MockClient(
+        [
+            ("dir/same.txt", 12, crc32c(b"dir/same.txt")),
+            ("dir/edited.txt", 4, crc32c(b"1234")),
+            ("dir/sub/new.txt", 15, crc32c(b"dir/sub/new.txt")),
+        ]
+    )
+
+    stdout, _, _ = gcs.sync("gs://bucket/dir", str(tmpdir), use_api=True, client=client)
+
+    assert sorted(client.downloads) == [
+        ("dir/edited.txt", str(tmpdir.join("edited.txt"))),
+        ("dir/sub/new.txt", str(tmpdir.join("sub").join("new.txt"))),
+    ]
+    assert not tmpdir.join("old.txt").check()
+    assert f"Removed {tmpdir.join('old.txt')}" in stdout.splitlines()
+
+
+def test_cp_api_downloads(tmpdir):
+    client = MockClient(["data/a.txt", "data/sub/b.txt"])
+
+    gcs.cp("gs://bucket/data", str(tmpdir), flags=["r"], use_api=True, client=client)
+    gcs.cp("/gcs/bucket/data/a.txt", str(tmpdir), use_api=True, client=client)
+
+    assert sorted(client.downloads[:2]) == [
+        ("data/a.txt", str(tmpdir.join("data").join("a.txt"))),
+        ("data/sub/b.txt", str(tmpdir.join("data").join("sub").join("b.txt"))),
+    ]
+    assert client.downloads[2] == ("data/a.txt", str(tmpdir.join("a.txt")))
+
+
+@pytest.mark.parametrize(
+    "func,kwargs",
+    [
+        (gcs.cp, {"flags": ["r", "n"], "use_api": True}),
+        (gcs.sync, {"flags": ["r", "c"], "use_api": True}),
+        (gcs.rm, {"flags": ["a"], "use_batch": True}),
+    ],
+)
+def test_api_rejects_unsupported_flags(tmpdir, func, kwargs):
+    client = MockClient(["dir/a.txt"])
+    paths = ["gs://bucket/dir"] if func is gcs.rm else [str(tmpdir), "gs://bucket/dir"]
+
+    with pytest.raises(ValueError, match="not supported"):
+        func(*paths, client=client, **kwargs)
+
+    assert client.calls == client.uploads == []
+
+
+def test_sync_api_ignores_log_when_choosing_files(tmpdir):
+    src = tmpdir.mkdir("data")
+    src.join("a.txt").write("edited")
+    log_path = str(tmpdir.join("log.jsonl"))
+    tmpdir.join("log.jsonl").write(
+        json.dumps({"name": "gs://bucket/dest/a.txt", "size": 1, "status": "ok"})
+        + "\n"
+    )
+    client = MockClient([("dest/a.txt", 1, crc32c(b"a"))])
+
+    gcs.sync(
+        str(src), "gs://bucket/dest", use_api=True, client=client, log_path=log_path
+    )
+
+    assert client.uploads == [(str(src.join("a.txt")), "dest/a.txt")]
+
+
+def test_rm_batch_retries_failed_batch_requests(no_sleep):
+    client = MockClient(["dir/a", "dir/b"])
+    client.batch_errors = [exceptions.ServiceUnavailable("unavailable")]
+
+    stdout, _, _ = gcs.rm("gs://bucket/dir", flags=["r"], use_batch=True, client=client)
+
+    assert client.batch_requests == 2
+    assert stdout.splitlines() == [
+        "Removed gs://bucket/dir/a",
+        "Removed gs://bucket/dir/b",
+    ]
+
+
+@pytest.mark.parametrize("max_files", [1, 2])
+def test_cp_api_limits_concurrent_chunked_uploads(tmpdir, mocker, max_files):
+    for i in range(8):
+        tmpdir.join(f"{i}.bin").write("0" * 10)
+    mocker.patch.object(gcs, "MULTIPART_THRESHOLD", 5)
+    mocker.patch.object(gcs, "MULTIPART_MAX_FILES", max_files)
+    lock = threading.Lock()
+    active = []
+    peak = []
+
+    def upload(*args, **kwargs):
+        with lock:
+            active.append(args[0])
+            peak.append(len(active))
+        time.sleep(0.05)
+        with lock:
+            active.remove(args[0])
+
+    chunked = mocker.patch.object(
+        gcs.transfer_manager, "upload_chunks_concurrently", side_effect=upload
+    )
+
+    client = MockClient([])
+    gcs.cp(str(tmpdir), "gs://bucket/dest", flags=["r"], use_api=True, client=client)
+
+    assert chunked.call_count == 8
+    assert max(peak) == max_files
+
+
+def test_cp_api_resumes_from_truncated_log(tmpdir):
+    src = tmpdir.mkdir("data")
+    src.join("a.txt").write("a")
+    src.join("b.txt").write("b")
+    log_path = str(tmpdir.join("log.jsonl"))
+    tmpdir.join("log.jsonl").write(
+        json.dumps({"name": "gs://bucket/dest/a.txt", "size": 1, "status": "ok"})
+        + '\n{"name": "gs://bucket/dest/b.t'
+    )
+    client = MockClient([])
+
+    gcs.cp(
+        str(src),
+        "gs://bucket/dest",
+        flags=["r"],
+        use_api=True,
+        client=client,
+        log_path=log_path,
+    )
+
+    assert client.uploads == [(str(src.join("b.txt")), "dest/b.txt")]
+    with open(log_path) as f:
+        lines = f.read().splitlines()
+    assert json.loads(lines[-1])["name"] == "gs://bucket/dest/b.txt"
+    assert gcs._read_transfer_log(log_path) == {
+        "gs://bucket/dest/a.txt",
+        "gs://bucket/dest/b.txt",
+    }